@@ -18,6 +18,7 @@ import uuid
 
 import arrow
 import flask
+import jinja2
 
 from . import model
 from .web import admin, indieauth, micropub, site
@@ -30,6 +31,17 @@ app = flask.Flask(
     template_folder=pathlib.Path("templates").absolute(),
 )
 
+# cache compiled templates on disk, so that new processes can skip parsing
+# them, and make the in-memory template cache large enough to hold all of
+# the templates and partials at once
+jinja_cache = pathlib.Path(".jinja_cache").absolute()
+jinja_cache.mkdir(exist_ok=True)
+app.jinja_options = {
+    **app.jinja_options,
+    "cache_size": 400,
+    "bytecode_cache": jinja2.FileSystemBytecodeCache(directory=str(jinja_cache)),
+}
+
 app.config.from_object("conf")
 app.secret_key = app.config["SESSION"]["key"]
 
@@ -39,24 +51,35 @@ app.register_blueprint(micropub.blueprint)
 app.register_blueprint(admin.blueprint)
 
 
+# Jinja templates get a very small set of context in their namespace, so
+# attach some useful references to make templating easier to deal with. These
+# never change, so they are installed once as globals rather than per request.
+app.jinja_env.globals.update(
+    model=model,
+    arrow=arrow,
+    uuid=uuid,
+    math=math,
+    float=float,
+    int=int,
+    min=min,
+    max=max,
+    len=len,
+)
+
+
+# compile every template at startup, rather than on the first request that
+# happens to render it
+for template in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template)
+
+
 @app.before_request
 def set_shared_context():
     """
-    Jinja templates get a very small set of context in their
-    namespace. Attach some useful references to make templating
-    easier to deal with.
+    Attach the request path to the shared context for templates.
     """
 
-    flask.g.model = model
-    flask.g.arrow = arrow
-    flask.g.uuid = uuid
     flask.g.path = flask.request.path
-    flask.g.math = math
-    flask.g.float = float
-    flask.g.int = int
-    flask.g.min = min
-    flask.g.max = max
-    flask.g.len = len
 
 
 @app.route("/admin/reload_data")
@@ -70,4 +93,5 @@ def reload_data():
     """
 
     result = model.database.reinitialize()
+    site.clear_response_cache()
     return dict(result=result)
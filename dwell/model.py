@@ -18,13 +18,17 @@ the DuckDB content database using SQL.
 
 
 import concurrent.futures
-import json
+import contextlib
+import datetime
+import functools
 import pathlib
 import threading
 import urllib.parse
+from functools import cached_property
 
 import arrow
 import duckdb
+import orjson
 
 
 class classproperty:
@@ -35,27 +39,195 @@ class classproperty:
         return self.fget(owner)
 
 
+# projection of `raw_content` into the `content` table, which extracts the
+# commonly queried fields from the MF2 JSON of each post, and leaves out
+# unfurled URLs, which are never displayed on their own. All of the fields
+# are extracted in a single `json_extract` call, so that each document is
+# only parsed once.
+CONTENT_SELECT = """select
+    parts[1]->>'$' "uuid",
+    lower(parts[2]->>'$') "kind",
+    parts[3]->>'$' "url",
+    coalesce(parts[4]->>'$', 'false')::BOOL "deleted",
+    (parts[5]->>'$')::TIMESTAMP "published",
+    parts[6]::STRUCT(
+        "timestamp" timestamp,
+        x float,
+        y float,
+        altitude int,
+        motion varchar[],
+        wifi varchar,
+        battery_level float,
+        battery_state varchar,
+        speed int,
+        year int,
+        month int,
+        day int,
+        hour int,
+        minute int
+    ) "location",
+    properties,
+    children,
+    filename,
+    year,
+    month,
+    day
+from (
+    select
+        json_extract(properties, [
+            '$."post-id"[0]',
+            '$."post-kind"[0]',
+            '$."url"[0]',
+            '$."deleted"[0]',
+            '$."published"[0]',
+            '$."location-metadata"'
+        ]) parts,
+        *
+    from raw_content
+)
+where "kind" is distinct from 'unfurledurl'"""
+
+
+# reinitialization happens in the background, on a single worker thread that
+# is shared for the life of the process
+_reinitialize_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="dwell-reinitialize"
+)
+
+
+class SharedLock:
+    """
+    A lock which any number of threads can hold in shared mode at once, or a
+    single thread can hold exclusively. Threads waiting for exclusive access
+    take priority over new shared holders, so that they aren't starved.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._condition:
+            while self._exclusive or self._waiting:
+                self._condition.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._shared -= 1
+                if not self._shared:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._waiting += 1
+            while self._exclusive or self._shared:
+                self._condition.wait()
+            self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
 class DatabaseManager:
     def __init__(self):
         self._conn = None
-        self._migrating = threading.Lock()
+        self._filename = None
+        self._local = threading.local()
+        # queries hold the lock in shared mode, and anything that replaces
+        # the connection, such as a write or a reinitialization, holds it
+        # exclusively
+        self._lock = SharedLock()
         self._reinitializing = threading.Lock()
+        self._migrate_callbacks = []
 
     def connect(self, filename="content.db", read_only=False):
+        # DuckDB can't open a database that doesn't exist yet in read-only
+        # mode, so create an empty one first
+        if read_only and not pathlib.Path(filename).exists():
+            duckdb.connect(filename).close()
+
+        self._filename = filename
         self._conn = duckdb.connect(filename, read_only=read_only)
 
-    @property
-    def connection(self):
-        with self._migrating:
-            return self._conn
+    # the connection may be replaced at any time by a reinitialization, so
+    # queries should go through `execute`, which guards against that
+    connection = property(lambda self: self._conn)
+
+    def _cursor(self):
+        # DuckDB connections aren't safe to use across threads, so each
+        # thread gets its own cursor, which is recreated whenever the
+        # underlying connection is replaced
+        local = self._local
+        if getattr(local, "connection", None) is not self._conn:
+            local.connection = self._conn
+            local.cursor = self._conn.cursor()
+        return local.cursor
+
+    def execute(self, sql, params=None):
+        """
+        Run the provided SQL with its parameters on a cursor for the current
+        thread, and return all of the resulting rows. The connection can't be
+        replaced while the query is running.
+        """
+
+        with self._lock.shared():
+            return self._cursor().execute(sql, params or []).fetchall()
+
+    def on_migrate(self, callback):
+        """
+        Register a callback to run whenever a reinitialized database has
+        replaced the current one, such as to drop anything derived from the
+        old content.
+        """
+
+        self._migrate_callbacks.append(callback)
 
     def disconnect(self):
         if self._conn:
             self._conn.close()
 
+    @contextlib.contextmanager
+    def _writer(self):
+        """
+        The shared connection is read-only, and DuckDB won't open the same
+        file twice in one process with different configurations, so writes
+        swap it for a short-lived read-write connection, make their changes
+        within a transaction, and then reconnect read-only. Queries wait
+        until the write is done.
+
+        DuckDB holds a lock on the file for as long as any process has it
+        open, so this fails if another process is reading the database. In
+        that case, callers fall back to `reinitialize`, which builds a new
+        database file alongside the current one.
+        """
+
+        with self._lock.exclusive():
+            self.disconnect()
+            try:
+                with duckdb.connect(self._filename) as connection:
+                    connection.begin()
+                    try:
+                        yield connection
+                        connection.commit()
+                    except Exception:
+                        connection.rollback()
+                        raise
+            finally:
+                self.connect(filename=self._filename, read_only=True)
+
     def _initialize(self, connection):
         connection.sql(
-            """
+            f"""
             PRAGMA memory_limit=-1;
             create table raw_content
             as
@@ -68,45 +240,21 @@ class DatabaseManager:
                 hive_partitioning='true',
                 filename='true'
             );
-            create view content as select
-                properties->'post-id'->>0 "uuid",
-                properties->'post-kind'->>0 "kind",
-                properties->'url'->>0 "url",
-                coalesce(
-                    (properties->'deleted'->>0), false
-                )::JSON::BOOL "deleted",
-                json_extract("properties",
-                    '$."published"[0]')::JSON::TIMESTAMP "published",
-                json_extract("properties",
-                    '$."location-metadata"')::JSON::STRUCT(
-                        "timestamp" timestamp,
-                        x float,
-                        y float,
-                        altitude int,
-                        motion varchar[],
-                        wifi varchar,
-                        battery_level float,
-                        battery_state varchar,
-                        speed int,
-                        year int,
-                        month int,
-                        day int,
-                        hour int,
-                        minute int
-                    ) "location",
-                properties,
-                children,
-                filename,
-                year,
-                month,
-                day
-            from raw_content;"""
+            -- order rows by date, so that min/max statistics on each row
+            -- group allow date-filtered queries to skip most of the table
+            create table content as {CONTENT_SELECT}
+            order by year, month, day, published;
+            create index content_uuid_idx on content(uuid);
+            create index content_url_idx on content(url);
+            create index content_published_idx on content(published);"""
         )
 
-    def add(self, path):
-        self.connection.sql(
+    def _insert(self, connection, path):
+        # columns are matched by name, as the order of keys in a single
+        # file needn't match the order inferred across all content
+        connection.execute(
             f"""
-            insert into raw_content
+            insert into raw_content by name
             select * from
             read_json_auto(
                 '{path}',
@@ -117,31 +265,98 @@ class DatabaseManager:
                 filename='true'
             );"""
         )
+        connection.execute(
+            f"insert into content select * from ({CONTENT_SELECT}) "
+            "where filename = ?",
+            [str(path)],
+        )
+
+    def add(self, path):
+        with self._writer() as connection:
+            self._insert(connection, path)
+
+    def upsert(self, path):
+        """
+        Replace the rows for a single content file that has changed on disk,
+        rather than re-ingesting its entire partition.
+        """
+
+        with self._writer() as connection:
+            connection.execute("delete from content where filename = ?", [str(path)])
+            connection.execute(
+                "delete from raw_content where filename = ?", [str(path)]
+            )
+            self._insert(connection, path)
+
+    def reinitialize_partition(self, year, month, day):
+        """
+        Re-ingest a single day of content from disk, rather than rebuilding
+        the entire database. Only the files in that day's Hive partition
+        directory are read.
+        """
+
+        params = [year, month, day]
+        partition = "year = ? and month = ? and day = ?"
+        directory = pathlib.Path(f"content/year={year}/month={month:02}/day={day:02}")
+
+        with self._writer() as connection:
+            connection.execute(f"delete from content where {partition}", params)
+            connection.execute(f"delete from raw_content where {partition}", params)
+
+            # every post from the day may have been removed from disk
+            if not any(directory.glob("*.json")):
+                return
+
+            connection.execute(
+                f"""
+                insert into raw_content by name
+                select * from
+                read_json_auto(
+                    '{directory}/*.json',
+                    format='auto',
+                    records=true,
+                    maximum_depth=1,
+                    hive_partitioning='true',
+                    filename='true'
+                );"""
+            )
+            connection.execute(
+                f"insert into content select * from ({CONTENT_SELECT}) "
+                f"where {partition}",
+                params,
+            )
 
     def _migrate(self, to_filename, from_filename):
         print("Initialization complete, migrating to new database.")
-        with self._migrating:
+        with self._lock.exclusive():
             self.disconnect()
             pathlib.Path(from_filename).rename(pathlib.Path(to_filename))
             self.connect(filename=to_filename, read_only=True)
+            _query_sql.cache_clear()
+        for callback in self._migrate_callbacks:
+            callback()
         print("Migration complete!")
 
     def reinitialize(self, target_filename="content.db"):
-        self._reinitializing.acquire()
+        # if a reinitialization is already underway, it will pick up any
+        # content that has changed, so there's no need to queue another
+        if not self._reinitializing.acquire(blocking=False):
+            print("Reinitialization already in progress.")
+            return False
 
         print("Reinitializing database from disk...")
 
         temp_filename = f"{target_filename}.initializing"
 
         def create_database():
-            conn = duckdb.connect(temp_filename)
-            self._initialize(conn)
+            with duckdb.connect(temp_filename) as conn:
+                self._initialize(conn)
 
         def done(future):
             if future.done():
                 error = future.exception()
                 if error:
-                    print("{}: error returned: {}".format(future.arg, error))
+                    print("Reinitialization failed: {}".format(error))
                     self._reinitializing.release()
                 else:
                     self._migrate(
@@ -149,20 +364,53 @@ class DatabaseManager:
                     )
                     self._reinitializing.release()
 
-        executor = concurrent.futures.ThreadPoolExecutor()
-        future = executor.submit(create_database)
+        future = _reinitialize_executor.submit(create_database)
         future.add_done_callback(done)
 
         return True
 
 
 database = DatabaseManager()
-database.connect()
+database.connect(read_only=True)
 
+# mapping tables from post kinds and aliases to Post subclasses, which are
+# populated as each subclass is defined
 kind_map = {}
 kind_aliases = {"default": []}
 
 
+def add_alias(alias, kind):
+    kind_aliases.setdefault(alias, []).append(kind)
+
+
+def get_kinds_for_alias(alias):
+    return kind_aliases.get(alias, [])
+
+
+# the only columns needed to instantiate a Post, selected in place of `*` so
+# that DuckDB doesn't materialize columns (like `location`) we never read
+POST_COLUMNS = "kind, properties, children, filename"
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO-8601 timestamp from MF2 JSON into a `datetime`. Nearly all
+    timestamps can be handled by `datetime.fromisoformat`, which is far
+    cheaper than Arrow's parser, so Arrow is only used as a fallback for
+    unusual formats. Timestamps without an offset are treated as UTC, as
+    Arrow does.
+    """
+
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return arrow.get(value).datetime
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
 class Author:
     """
     Represents an `h-card` for an author of content on a site.
@@ -190,11 +438,7 @@ class Comment:
         self.text = h_cite["properties"]["content"][0]["value"]
         self.author = Author(h_cite["properties"]["author"][0])
         self.url = h_cite["properties"]["url"][0]
-
-    @property
-    def source(self):
-        url = urllib.parse.urlparse(self.url)
-        return url.hostname
+        self.source = urllib.parse.urlsplit(self.url).hostname
 
 
 class Like:
@@ -205,12 +449,58 @@ class Like:
     def __init__(self, h_cite):
         self.author = Author(h_cite["properties"]["author"][0])
         self.url = h_cite["properties"]["url"][0]
-        self.published = arrow.get(h_cite["properties"]["published"][0])
+        self.published = parse_timestamp(h_cite["properties"]["published"][0])
+        self.source = urllib.parse.urlsplit(self.url).hostname
 
-    @property
-    def source(self):
-        url = urllib.parse.urlparse(self.url)
-        return url.hostname
+
+def _deserialize(value):
+    """
+    DuckDB returns `JSON` columns as text, but native `STRUCT`, `MAP`, and
+    `LIST` columns arrive already converted to Python objects. Only parse
+    values that are still serialized.
+    """
+
+    if isinstance(value, (dict, list)):
+        return value
+    return orjson.loads(value)
+
+
+@functools.lru_cache(maxsize=64)
+def _query_sql(has_range, has_year, has_month, has_day, has_kinds, count, sort):
+    """
+    Build the SQL for a `Post.query` of the specified shape. Only the shape
+    of the query is part of the cache key, and all values are bound as
+    parameters, so paginated queries reuse the same statement text.
+    """
+
+    where = ["deleted = false"]
+    if has_range:
+        where.extend(["published >= ?", "published <= ?"])
+
+    if has_year:
+        where.append("year = ?")
+
+    if has_month:
+        where.append("month = ?")
+
+    if has_day:
+        where.append("day = ?")
+
+    # kinds are bound as a single list so that the statement text doesn't
+    # depend on how many kinds are being filtered on
+    if has_kinds:
+        where.append("list_contains(?, kind)")
+
+    # static pages are kept in the content table so they can be fetched
+    # directly, but they never appear in a stream of posts
+    where.append("kind != 'staticpage'")
+
+    if count:
+        return "select count(*) from content where " + " and ".join(where)
+
+    paging = [f"order by published {sort}", "limit ?", "offset ?"]
+    select = f"select {POST_COLUMNS} from content where"
+    return " ".join([select, " and ".join(where), *paging])
 
 
 class Post:
@@ -230,13 +520,31 @@ class Post:
         """
         Construct a representation of the specified post from the
         included MF2 JSON dictionary, list of children, and filename
-        on disk.
+        on disk. The children may also be provided still serialized as
+        JSON, in which case they are only parsed if they are accessed.
         """
 
         self.mf2 = mf2
-        self.children = children
+        self._children = children
         self.filename = filename
 
+    def __init_subclass__(cls, **kwargs):
+        """
+        Register each new kind of post, and its aliases, as it is defined.
+        Subclasses that don't declare their own `__kind__` are left alone,
+        so they don't replace the kind they inherit from.
+        """
+
+        super().__init_subclass__(**kwargs)
+
+        if "__kind__" not in cls.__dict__:
+            return
+
+        kind_map[cls.__kind__] = cls
+        add_alias(cls.__kind__, cls)
+        for alias in cls.__aliases__:
+            add_alias(alias, cls)
+
     def __str__(self):
         parts = [f"{self.__class__.__name__}: {self.url}"]
 
@@ -254,7 +562,7 @@ class Post:
             mapping[kind_key] = kind_cls.__kind_name__
         return mapping
 
-    @property
+    @cached_property
     def content(self):
         """
         Convenience property for the content record on this post.
@@ -270,27 +578,44 @@ class Post:
     kind_name = classproperty(lambda self: self.__kind_name__)
     kind_icon = classproperty(lambda self: self.__kind_icon__)
 
-    # convenience properties for fetching the raw, on-disk JSON representation
-    # for this post, the MF2 data structure that has been parsed, and the HTML
-    # content or text value within the post
-    raw = property(lambda self: json.loads(open(self.filename, "rb").read()))
+    @cached_property
+    def raw(self):
+        """
+        The raw, on-disk JSON representation for this post, read from disk
+        at most once per instance.
+        """
+        with open(self.filename, "rb") as f:
+            return orjson.loads(f.read())
+
+    # children are only used by a handful of kinds, so they're deserialized
+    # on first access, rather than for every post that is queried
+    children = cached_property(
+        lambda self: _deserialize(self._children) if self._children else []
+    )
+
+    # convenience properties for the MF2 data structure that has been parsed,
+    # and the HTML content or text value within the post
     json = property(lambda self: {"type": ["h-entry"], "properties": self.mf2})
     html = property(lambda self: self.content["html"])
     value = property(lambda self: self.content["value"])
 
     # convenience properties for the name, author, url, syndication references,
     # post identifier, publish datetime, location metadata, soft delete status,
-    # comments, likes, and photos on this post
+    # comments, likes, and photos on this post; those that construct objects
+    # are cached, as templates tend to access them several times per render
     name = property(lambda self: self.mf2.get("name", [""])[0])
-    author = property(lambda self: Author(self.mf2["author"][0]))
+    author = cached_property(lambda self: Author(self.mf2["author"][0]))
     url = property(lambda self: self.mf2["url"][0])
     syndication = property(lambda self: self.mf2["syndication"])
     uuid = property(lambda self: self.mf2["post-id"][0])
-    published = property(lambda self: arrow.get(self.mf2["published"][0]))
+    published = cached_property(lambda self: parse_timestamp(self.mf2["published"][0]))
+    published_arrow = cached_property(lambda self: arrow.get(self.published))
     location = property(lambda self: self.mf2.get("location-metadata"))
     deleted = property(lambda self: self.mf2.get("deleted", [False])[0])
-    comments = property(lambda self: [Comment(h) for h in self.mf2.get("comment", [])])
-    likes = property(lambda self: [Like(h) for h in self.mf2.get("like", [])])
+    comments = cached_property(
+        lambda self: [Comment(h) for h in self.mf2.get("comment", [])]
+    )
+    likes = cached_property(lambda self: [Like(h) for h in self.mf2.get("like", [])])
     photos = property(lambda self: self.mf2.get("photo", []))
 
     @classmethod
@@ -301,21 +626,22 @@ class Post:
         instance of Post, but raw columnar data from the database.
         """
 
-        sql = "select * from content where "
+        sql = f"select {POST_COLUMNS} from content where "
+        params = []
         if uuid:
-            sql += f"uuid = '{uuid}'"
+            sql += "uuid = ?"
+            params.append(uuid)
         elif slug:
-            if year:
-                sql += f"url = '/{year}/{slug}'"
-            else:
-                sql += f"url = '{slug}'"
+            sql += "url = ?"
+            params.append(f"/{year}/{slug}" if year else slug)
         else:
             raise Exception("Please provide a uuid or slug.")
 
         if year:
-            sql += f" and datepart('year', published) = {year}"
+            sql += " and datepart('year', published) = ?"
+            params.append(int(year))
 
-        result = database.connection.sql(sql).fetchall()
+        result = database.execute(sql, params)
         return result[0] if result else None
 
     @classmethod
@@ -323,14 +649,14 @@ class Post:
         """
         Internal class method for instantiating an instance of the
         correct Post subclass for the specified DuckDB record for a
-        specific post.
+        specific post. Records are expected to contain `POST_COLUMNS`.
         """
 
-        kind = record[1].lower() if record[1] else None
+        kind, properties, children, filename = record
         return kind_map.get(kind, cls)(
-            mf2=json.loads(record[6]),
-            children=json.loads(record[7]) if record[7] else [],
-            filename=record[8],
+            mf2=_deserialize(properties),
+            children=children,
+            filename=filename,
         )
 
     @classmethod
@@ -374,62 +700,42 @@ class Post:
         - `month` is an integer allowing to filter by publish month.
         - `day` is an integer allowing to filter by publish day.
         - `year` is an integer allowing to filter by publish year.
-        - `kinds` is a list of post kinds or kind aliases to filter by.
+        - `kinds` is a list of lowercase post kinds to filter by.
         - `count` is a boolean that defaults to `False`. If `True`, the method
           will return the total number of posts that match the query.
         """
 
-        parts = []
+        # the sort direction can't be bound as a parameter, so make sure it
+        # is one of the two literals we expect before it is interpolated
+        sort = "asc" if sort == "asc" else "desc"
 
-        where = ["deleted = false"]
-        if start and end:
-            where.extend(
-                [
-                    f"published >= '{start.isoformat()}'",
-                    f"published <= '{end.isoformat()}'",
-                ]
-            )
-
-        if year:
-            where.append(f"year = {year}")
+        params = []
+        has_range = bool(start and end)
+        if has_range:
+            params.extend([start, end])
 
-        if month:
-            where.append(f"month = {month}")
-
-        if day:
-            where.append(f"day = {day}")
+        # integer arguments are coerced up front, so that invalid values are
+        # rejected before any SQL is executed
+        for value in (year, month, day):
+            if value:
+                params.append(int(value))
 
         if cls.__name__ != "Post":
             kinds = [cls.__kind__]
 
         if kinds:
-            kinds = [kind.capitalize() for kind in kinds]
-            where.append(f"kind in {str(tuple(kinds))}")
+            params.append(list(kinds))
 
-        # TODO: fix this on the ingest side
-        where.append("kind != 'UnfurledUrl'")
-        where.append("kind != 'StaticPage'")
+        sql = _query_sql(
+            has_range, bool(year), bool(month), bool(day), bool(kinds), count, sort
+        )
 
         if count:
-            sql = "select count(*) from content" + " ".join(parts)
-            if where:
-                sql += " where " + " and ".join(where)
-            result = database.connection.sql(sql).fetchone()[0]
-            return result
-
-        paging = [f"order by published {sort}", f"limit {limit}", f"offset {offset}"]
+            return database.execute(sql, params)[0][0]
 
-        sql = "select * from content" + " ".join(parts)
-        if where:
-            sql += " where " + " and ".join(where)
-
-        sql += " " + " ".join(paging)
-
-        results = database.connection.sql(sql)
-        posts = []
-        for result in results.fetchall():
-            posts.append(cls._instantiate(result))
-        return posts
+        params.extend([int(limit), int(offset)])
+        results = database.execute(sql, params)
+        return [cls._instantiate(result) for result in results]
 
 
 class Blog(Post):
@@ -713,19 +1019,3 @@ class RSVP(Post):
     __aliases__ = ["rsvps"]
 
     response = property(lambda self: self.mf2["rsvp"][0])
-
-
-# create a mapping table from post kinds and aliases to Post subclasses
-def add_alias(alias, kind):
-    kind_aliases.setdefault(alias, []).append(kind)
-
-
-def get_kinds_for_alias(alias):
-    return kind_aliases.get(alias, [])
-
-
-for subclass in Post.__subclasses__():
-    kind_map[subclass.__kind__] = subclass
-    kind_aliases.setdefault(subclass.__kind__, []).append(subclass)
-    for alias in subclass.__aliases__:
-        add_alias(alias, subclass)
@@ -4,9 +4,18 @@ It attempts to be a complete implementation with convenient decorators to
 secure endpoints.
 """
 
+import base64
+import contextlib
+import dataclasses
 import datetime
+import fcntl
 import hashlib
+import hmac
+import json
+import os
 import pathlib
+import threading
+import time
 import uuid
 from functools import wraps
 from urllib.parse import urlencode
@@ -23,19 +32,170 @@ blueprint = flask.Blueprint(
 )
 
 
-# create a DuckDB database for tokens/codes
-authdb = duckdb.connect("indieauth.db")
-authdb.sql(
-    """create table if not exists codes (
-    code varchar,
-    client_id varchar,
-    redirect_url varchar,
-    created timestamp,
-    expires timestamp,
-    me varchar,
-    scope varchar
-)"""
-)
+@dataclasses.dataclass(slots=True)
+class CodeRecord:
+    """
+    An access token issued by the IndieAuth endpoint. Timestamps are
+    stored as epoch seconds, so that checking expiration is a single float
+    comparison.
+    """
+
+    client_id: str
+    redirect_url: str
+    created: float
+    expires: float
+    me: str
+    scope: str
+
+
+# access tokens are few, so they are held in memory, and persisted to a JSON
+# file on disk whenever a new token is issued. Each worker process reloads the
+# file when another has replaced it, and writers take a lock on a separate
+# file, so that tokens issued by one process are never lost by another.
+CODES_FILENAME = pathlib.Path("indieauth.json")
+CODES_LOCK_FILENAME = pathlib.Path("indieauth.json.lock")
+REDEEMED_FILENAME = pathlib.Path("indieauth.redeemed.json")
+LEGACY_CODES_FILENAME = pathlib.Path("indieauth.db")
+
+_codes_lock = threading.Lock()
+
+# authorization codes are valid for ten minutes, and each may only be redeemed
+# once, so the identifiers of redeemed codes are kept on disk alongside the
+# tokens until they expire, where every worker process can see them. Codes
+# carry a `typ` claim, which tells them apart from access tokens.
+CODE_LIFETIME = 600
+CODE_TYPE = "code"
+
+
+def _load_codes():
+    """
+    Load all tokens from disk. If no tokens have been stored yet, but a
+    DuckDB database from earlier versions of Dwell exists, import its
+    codes instead, so that existing clients remain authorized.
+    """
+
+    if CODES_FILENAME.exists():
+        with open(CODES_FILENAME, "rb") as f:
+            return {
+                code: CodeRecord(**record) for code, record in json.load(f).items()
+            }
+
+    codes = {}
+    if LEGACY_CODES_FILENAME.exists():
+        with duckdb.connect(str(LEGACY_CODES_FILENAME), read_only=True) as db:
+            rows = db.execute(
+                """select code, client_id, redirect_url, created, expires, me, scope
+                from codes"""
+            ).fetchall()
+        for code, client_id, redirect_url, created, expires, me, scope in rows:
+            codes[code] = CodeRecord(
+                client_id=client_id,
+                redirect_url=redirect_url,
+                created=arrow.get(created).timestamp(),
+                expires=arrow.get(expires).timestamp(),
+                me=me,
+                scope=scope,
+            )
+    return codes
+
+
+def _codes_file_version():
+    # the file is always replaced rather than rewritten in place, so a new
+    # inode or modification time means that the tokens have changed
+    try:
+        stat = CODES_FILENAME.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _refresh_codes():
+    """
+    Reload all tokens from disk if another process has written them since
+    they were last loaded. Must be called while holding `_codes_lock`.
+    """
+
+    global _codes, _codes_version
+
+    version = _codes_file_version()
+    if version != _codes_version:
+        _codes = _load_codes()
+        _codes_version = version
+
+
+@contextlib.contextmanager
+def _writing_codes():
+    """
+    Lock the tokens against changes from other threads and processes, and
+    bring them up to date with the disk, so that they can be modified and
+    then saved.
+    """
+
+    with _codes_lock, open(CODES_LOCK_FILENAME, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _refresh_codes()
+        yield
+
+
+def _write_json(filename, data):
+    temp_filename = filename.with_suffix(".json.tmp")
+    with open(temp_filename, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_filename, filename)
+
+
+def _save_codes():
+    """
+    Atomically write all tokens to disk. Must be called within
+    `_writing_codes`.
+    """
+
+    global _codes_version
+
+    _write_json(
+        CODES_FILENAME, {code: dataclasses.asdict(r) for code, r in _codes.items()}
+    )
+    _codes_version = _codes_file_version()
+
+
+def _redeem(jti, expires):
+    """
+    Record that the authorization code with the provided identifier has been
+    redeemed, and return `False` if it already was. Identifiers of expired
+    codes are dropped along the way. Must be called within `_writing_codes`.
+    """
+
+    now = time.time()
+    redeemed = {}
+    if REDEEMED_FILENAME.exists():
+        with open(REDEEMED_FILENAME, "rb") as f:
+            redeemed = {k: v for k, v in json.load(f).items() if v >= now}
+
+    if jti in redeemed:
+        return False
+
+    redeemed[jti] = expires
+    _write_json(REDEEMED_FILENAME, redeemed)
+    return True
+
+
+_codes_version = _codes_file_version()
+_codes = _load_codes()
+
+
+@blueprint.before_app_request
+def parse_bearer_token():
+    """
+    Pull the bearer token, if any, off the `Authorization` header once per
+    request, for use by `require_auth` and the token endpoint. This runs for
+    every blueprint, as `require_auth` also secures micropub endpoints.
+    """
+
+    header = flask.request.headers.get("Authorization", "")
+    scheme, _, token = header.partition(" ")
+    flask.g.bearer_token = None
+    if scheme.lower() == "bearer":
+        flask.g.bearer_token = token.strip() or None
 
 
 def require_auth(func):
@@ -49,12 +209,11 @@ def require_auth(func):
     @wraps(func)
     def wrap(*args, **kwargs):
         # logged in users are provided all scopes by default
-        if flask_login.current_user:
+        if flask_login.current_user.is_authenticated:
             flask.request.authorized_scopes = ["create", "update", "delete", "undelete"]
             return func(*args, **kwargs)
 
-        token = getattr(flask.request.authorization, "token", None)
-        scopes = is_authorized(token)
+        scopes = is_authorized(flask.g.bearer_token)
         if scopes:
             flask.request.authorized_scopes = scopes
             return func(*args, **kwargs)
@@ -82,36 +241,34 @@ def verify_password(me, password):
     """
 
     me = normalize_me(me)
+    found_pass = app.config["PASSWORDS"]["passwords"].get(me)
+    if found_pass is None:
+        return False
+
     pass_hash = hashlib.sha256(
         (password + app.config["PASSWORDS"]["salt"]).encode("utf-8")
     ).hexdigest()
-    found_pass = app.config["PASSWORDS"]["passwords"].get(me)
-    return pass_hash == found_pass
+
+    # compare in constant time, so response timing doesn't leak the hash
+    return hmac.compare_digest(pass_hash.encode("utf-8"), found_pass.encode("utf-8"))
 
 
 def is_authorized(code):
     """
-    Check the IndieAuth database for the provided code and return
+    Check the stored IndieAuth tokens for the provided token and return
     `False` if the code is not found, invalid, or expired. In the
     case that the code is valid, return the scopes that the code
     is authorized for.
     """
 
-    record = authdb.sql(
-        f"""
-        select scope, expires from codes
-        where code='{code}'
-    """
-    ).fetchone()
-
-    if not record:
-        return False
+    if _codes_file_version() != _codes_version:
+        with _codes_lock:
+            _refresh_codes()
 
-    now = arrow.get()
-    expires = arrow.get(record[1])
+    record = _codes.get(code)
 
-    if now < expires:
-        return record[0].split(" ")
+    if record and time.time() < record.expires:
+        return record.scope.split(" ")
 
     return False
 
@@ -129,59 +286,101 @@ def enforce_authorized_scope(scope):
     flask.abort(401, f"Token not authorized for scope: {scope}")
 
 
-def check_code(code, redirect_url, client_id):
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+# the encoded JOSE header is identical for every HS256 token we issue
+HS256_HEADER = _b64encode(b'{"alg":"HS256","typ":"JWT"}')
+
+
+def sign(payload):
     """
-    For the specified code, redirect_url, and client_id,
-    return the details (`created` datetime, `expires` datetime,
-    `me` reference, and authorized `scope` list.
+    Sign the provided payload as a JWT with the configured secret and
+    algorithm. HS256, the default, is a single HMAC over the encoded header
+    and payload, so those tokens are assembled directly rather than through
+    PyJWT's generic algorithm machinery. The result is byte-for-byte what
+    PyJWT would produce.
     """
 
-    result = authdb.sql(
-        f"""
-        select created, expires, me, scope from codes where
-        code='{code}' and
-        client_id='{client_id}' and
-        redirect_url='{redirect_url}'
+    secret = app.config["TOKEN"]["secret"]
+    algorithm = app.config["TOKEN"]["algorithm"]
+
+    if algorithm == "HS256":
+        signing_input = (
+            HS256_HEADER
+            + b"."
+            + _b64encode(json.dumps(payload, separators=(",", ":")).encode())
+        )
+        signature = hmac.new(secret.encode(), signing_input, hashlib.sha256)
+        return (signing_input + b"." + _b64encode(signature.digest())).decode()
+
+    token = jwt.encode(payload, secret, algorithm)
+
+    # older releases of PyJWT return bytes rather than a string
+    return token.decode("utf-8") if isinstance(token, bytes) else token
+
+
+def verify_code(code, redirect_uri, client_id):
+    """
+    Authorization codes are signed JWTs, so they can be verified without
+    any storage. For the specified code, redirect_uri, and client_id,
+    return the details (`me` reference and authorized `scope`) if the code
+    is valid, unexpired, and hasn't already been redeemed, otherwise `None`.
     """
-    ).fetchone()
 
-    return dict(created=result[0], expires=result[1], me=result[2], scope=result[3])
+    try:
+        claims = jwt.decode(
+            code,
+            app.config["TOKEN"]["secret"],
+            algorithms=[app.config["TOKEN"]["algorithm"]],
+            options={"require": ["exp", "jti"]},
+        )
+    except jwt.InvalidTokenError:
+        return None
+
+    # access tokens are signed with the same secret, so make sure that this
+    # really is an authorization code
+    if (
+        claims.get("typ") != CODE_TYPE
+        or claims.get("client_id") != client_id
+        or claims.get("redirect_uri") != redirect_uri
+    ):
+        return None
+
+    # codes may only be redeemed once, so remember each one until it expires
+    with _writing_codes():
+        if not _redeem(claims["jti"], claims["exp"]):
+            return None
+
+    return dict(me=claims["me"], scope=claims["scope"])
 
 
 def create_code(me, client_id, redirect_uri, scope, code, expires=None):
     """
-    Create a new code in the IndieAuth database for the specified client,
+    Create and store a new IndieAuth access token for the specified client,
     redirect url, state, response type, scopes, and code. Optionally, an
     expiration datetime can be specified. If an expiration is not specified,
     authorize the code for 100 years.
     """
 
-    created = arrow.get()
+    created = datetime.datetime.now(datetime.timezone.utc)
     if not expires:
-        expires = created.shift(years=+100)
+        expires = created + datetime.timedelta(days=365 * 100)
 
-    authdb.sql(
-        f"""
-        insert into codes(
-            code,
-            client_id,
-            redirect_url,
-            created,
-            expires,
-            me,
-            scope
-        ) values (
-            '{code}',
-            '{client_id}',
-            '{redirect_uri}',
-            '{created.isoformat()}',
-            '{expires.isoformat()}',
-            '{me}',
-            '{scope}'
-        )
-    """
+    record = CodeRecord(
+        client_id=client_id,
+        redirect_url=redirect_uri,
+        created=created.timestamp(),
+        expires=expires.timestamp(),
+        me=me,
+        scope=scope,
     )
 
+    with _writing_codes():
+        _codes[code] = record
+        _save_codes()
+
 
 @blueprint.route("/indieauth/auth", methods=["GET"])
 def auth_get():
@@ -223,15 +422,15 @@ def auth_post():
     """
     HTTP POST /indieauth/auth
 
-    If a `code` is passed into this endpoint, then we are to validate that
-    authorization code against our cache with the `redirect_uri` and
-    `client_id` parameters. If we find a match, we are to return the `me`
-    URL that is associated with the authorization code.
+    If a `code` is passed into this endpoint, then we are to verify that
+    authorization code with the `redirect_uri` and `client_id` parameters.
+    If it is valid, we are to return the `me` URL that is associated with
+    the authorization code.
 
     If a `code` is not passed into this endpoint, but `approve` is passed
-    along as "Approve," then we generate an authorization token, and store
-    it in our cache, before finally redirecting to the provided
-    `redirect_uri`, passing along the `code` and `state`.
+    along as "Approve," then we generate a signed authorization code, before
+    finally redirecting to the provided `redirect_uri`, passing along the
+    `code` and `state`.
     """
 
     me = flask.request.form["me"]
@@ -246,8 +445,8 @@ def auth_post():
     me = normalize_me(me)
 
     if code is not None:
-        found_code = check_code(
-            code=code, redirect_url=redirect_uri, client_id=client_id
+        found_code = verify_code(
+            code=code, redirect_uri=redirect_uri, client_id=client_id
         )
         if found_code is not None:
             return dict(me=normalize_me(found_code["me"]))
@@ -260,16 +459,18 @@ def auth_post():
         if not verify_password(me, password):
             flask.abort(403, "Invalid password.")
 
-        # generate auth code
-        code = str(uuid.uuid4())
-
-        # store code in our storage
-        create_code(
-            me=me,
-            client_id=client_id,
-            redirect_uri=redirect_uri,
-            scope=scope,
-            code=code,
+        # generate a signed, short-lived auth code, which carries everything
+        # needed to verify it later
+        code = sign(
+            {
+                "me": me,
+                "client_id": client_id,
+                "redirect_uri": redirect_uri,
+                "scope": scope,
+                "exp": int(time.time()) + CODE_LIFETIME,
+                "jti": uuid.uuid4().hex,
+                "typ": CODE_TYPE,
+            }
         )
 
         # redirect to the requesting application
@@ -278,6 +479,23 @@ def auth_post():
         return flask.redirect(uri)
 
 
+def token_response(data):
+    """
+    Build a token endpoint response for the provided data, which is JSON if
+    the client asks for it, and form-encoded otherwise.
+    """
+
+    best = flask.request.accept_mimetypes.best_match(
+        ["application/x-www-form-urlencoded", "application/json"]
+    )
+    if best == "application/json":
+        return flask.jsonify(data)
+
+    return flask.Response(
+        urlencode(data), mimetype="application/x-www-form-urlencoded"
+    )
+
+
 @blueprint.route("/indieauth/token", methods=["GET"])
 def token_get():
     """
@@ -287,31 +505,31 @@ def token_get():
     header as a `Bearer` token.
     """
 
-    response = flask.Response()
-
-    # pull the token off the Authorization header
-    token = flask.request.headers.get("Authorization", "Bearer X").split(" ")[1]
-
-    # validate token
+    # validate the token from the Authorization header
     try:
         payload = jwt.decode(
-            token,
+            flask.g.bearer_token,
             app.config["TOKEN"]["secret"],
             algorithms=[app.config["TOKEN"]["algorithm"]],
         )
-        if payload.get("response_type") == "id":
-            response.status = 400
-            return {"error": "invalid_grant"}
-
-        return flask.render_template(
-            "indieauth/urlencode.html",
-            me=normalize_me(payload["me"]),
-            client_id=payload["client_id"],
-            scope=payload["scope"],
-        )
     except Exception:
         flask.abort(403, "Invalid token.")
 
+    # authorization codes aren't access tokens
+    if payload.get("typ") == CODE_TYPE:
+        flask.abort(403, "Invalid token.")
+
+    if payload.get("response_type") == "id":
+        return {"error": "invalid_grant"}, 400
+
+    return token_response(
+        {
+            "me": normalize_me(payload["me"]),
+            "client_id": payload["client_id"],
+            "scope": payload["scope"],
+        }
+    )
+
 
 @blueprint.route("/indieauth/token", methods=["POST"])
 def token_post():
@@ -320,42 +538,52 @@ def token_post():
 
     An external application is requesting an access token. They have
     an authorization `code` for the user identified by `me`. We will
-    verify the code, and then redirect to the `redirect_uri`, providing
-    the verified `me` and `scope` associated with the access `code`.
+    verify the code, and then respond with the verified `me` and `scope`
+    associated with the access `code`, along with a new access token.
     """
 
-    code = flask.request.args.get("code")
-    me = flask.request.args.get("me")
-    redirect_uri = flask.request.args.get("redirect_uri")
-    client_id = flask.request.args.get("client_id")
+    # clients send these in the form body, though older ones used the query
+    code = flask.request.values.get("code")
+    me = flask.request.values.get("me")
+    redirect_uri = flask.request.values.get("redirect_uri")
+    client_id = flask.request.values.get("client_id")
 
-    # look for a matching authorization code
-    found_code = check_code(code=code, redirect_uri=redirect_uri, client_id=client_id)
+    # verify the authorization code
+    found_code = verify_code(code=code, redirect_uri=redirect_uri, client_id=client_id)
+
+    # if we found one, generate and store a token. Newer clients don't send
+    # `me`, but if one is provided it must match the code.
+    if found_code is not None and (
+        me is None or normalize_me(me) == normalize_me(found_code["me"])
+    ):
+        me = normalize_me(found_code["me"])
 
-    # if we found one, generate and store a token
-    me = normalize_me(me)
-    if found_code is not None and normalize_me(found_code["me"]) == me:
         # generate a token
-        token = jwt.encode(
+        token = sign(
             {
                 "me": me,
                 "client_id": client_id,
                 "scope": found_code["scope"],
-                "date_issued": str(datetime.utcnow()),
+                "date_issued": str(datetime.datetime.now(datetime.timezone.utc)),
                 "nonce": str(uuid.uuid4()),
-            },
-            app.config["TOKEN"]["secret"],
-            app.config["TOKEN"]["algorithm"],
-        ).decode("utf-8")
-
-        # construct the return payload
-        data = {
-            "me": normalize_me(found_code["me"]),
-            "scope": found_code["scope"],
-            "access_token": token,
-        }
+            }
+        )
+
+        response = token_response(
+            {"me": me, "scope": found_code["scope"], "access_token": token}
+        )
+
+        # store the token only once it can be delivered, so that it can be
+        # used to authorize requests
+        create_code(
+            me=me,
+            client_id=client_id,
+            redirect_uri=redirect_uri,
+            scope=found_code["scope"],
+            code=token,
+        )
 
-        return flask.render_template("indieauth/urlencode.html", data)
+        return response
 
     # if we didn't find one, reject the request
     flask.abort(401, "Invalid auth code.")
@@ -6,19 +6,24 @@ which aims to completly comply with the Micropub specification, including
 CRUD operations, syndication, and media endpoint.
 """
 
-import json
+import concurrent.futures
+import datetime
+import hashlib
+import os
 import pathlib
+import re
+import tempfile
 import urllib.parse
 import uuid
 
-import arrow
 import flask
 import hashfs
+import orjson
 import slugify
 from flask.app import current_app as app
 
 from .. import model
-from . import indieauth
+from . import indieauth, site
 
 # instantiate the blueprint for the micropub endpoint
 blueprint = flask.Blueprint(
@@ -28,6 +33,22 @@ blueprint = flask.Blueprint(
 # create a hashfs media storage directory
 media_store = hashfs.HashFS("static/media", depth=3, width=2, algorithm="sha256")
 
+# uploads are copied into the media store one mebibyte at a time, and the
+# files attached to a single post are stored side by side
+MEDIA_CHUNK_SIZE = 1 << 20
+_upload_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="dwell-upload"
+)
+
+# responses to the config and syndication queries never change, so they are
+# encoded once up front
+CONFIG_RESPONSE = orjson.dumps({"media-endpoint": "/micropub/media"})
+SYNDICATE_TO_RESPONSE = orjson.dumps({"syndicate-to": []})
+
+# patterns used to build slugs from plain ASCII text without python-slugify
+SLUG_NUMBER_SEPARATORS = re.compile(r"(?<=\d),(?=\d)")
+SLUG_DISALLOWED_CHARS = re.compile(r"[^a-z0-9]+")
+
 
 @blueprint.route("/micropub", methods=["GET"])
 def micropub_get():
@@ -39,14 +60,16 @@ def micropub_get():
     and fetching raw JSON representations of content.
     """
 
-    if flask.request.args.get("q") == "config":
-        return {"media-endpoint": "/micropub/media"}
+    q = flask.request.args.get("q")
+
+    if q == "config":
+        return flask.Response(CONFIG_RESPONSE, mimetype="application/json")
 
     # TODO: syndication configuration and response
-    if flask.request.args.get("q") == "syndicate-to":
-        return {"syndicate-to": []}
+    if q == "syndicate-to":
+        return flask.Response(SYNDICATE_TO_RESPONSE, mimetype="application/json")
 
-    if flask.request.args.get("q") == "source":
+    if q == "source":
         if flask.request.args.get("url"):
             url = urllib.parse.urlparse(flask.request.args.get("url"))
             post = None
@@ -76,7 +99,7 @@ def micropub_post():
     # first, get our JSON payload and response object set up
     payload = {}
     response = flask.Response()
-    now = arrow.get()
+    now = datetime.datetime.now(datetime.timezone.utc)
 
     # determine content type
     content_type = flask.request.headers["Content-Type"]
@@ -155,24 +178,26 @@ def micropub_post():
     generate_slug_and_uuid(payload)
 
     # store the raw content on disk
-    content = json.dumps(payload, indent=2)
+    content = orjson.dumps(payload, option=orjson.OPT_INDENT_2)
     content_path = pathlib.Path(
         f"content/year={now.year}/month={now.month:02}/day={now.day:02}"
     )
     content_path.mkdir(exist_ok=True, parents=True)
     content_path = content_path / f'{payload["properties"]["post-id"][0]}.json'
 
-    with open(content_path, "w") as f:
+    with open(content_path, "wb") as f:
         f.write(content)
 
     # attempt to add the record to the database without a full scan
-    # and if the attempt fails, reinitialize the database
+    # and if the attempt fails, re-ingest the partition for the post
     try:
         print("Adding new post to database: ", content_path)
         model.database.add(content_path)
     except Exception:
-        print("Failed to add content. Reinitializing database.")
-        model.database.reinitialize()
+        print("Failed to add content. Reinitializing partition.")
+        refresh_partition(content_path)
+
+    site.clear_response_cache()
 
     # redirect to the rendered content
     response.status_code = 202
@@ -209,11 +234,32 @@ def media_upload():
 def upload_media(file):
     """
     Store the provided file in the media store and return a permalink to
-    the content itself.
+    the content itself. The upload is hashed as it is copied to a temporary
+    file inside the media store, so it is only read once, never held in
+    memory, and can be moved into place without copying it again.
     """
 
-    media = media_store.put(file.stream)
-    return f"/media/{media.relpath}"
+    digest = hashlib.new(media_store.algorithm)
+    media_store.makepath(media_store.root)
+    tmp = tempfile.NamedTemporaryFile(
+        dir=media_store.root, prefix=".upload-", delete=False
+    )
+    try:
+        with tmp:
+            while chunk := file.stream.read(MEDIA_CHUNK_SIZE):
+                digest.update(chunk)
+                tmp.write(chunk)
+
+        filepath = media_store.idpath(digest.hexdigest())
+        if not os.path.isfile(filepath):
+            media_store.makepath(os.path.dirname(filepath))
+            os.chmod(tmp.name, media_store.fmode)
+            os.replace(tmp.name, filepath)
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+
+    return f"/media/{media_store.relpath(filepath)}"
 
 
 def decode_mf2(post, media_upload=False):
@@ -233,13 +279,12 @@ def decode_mf2(post, media_upload=False):
 
         mf2["properties"][key.replace("[]", "")] = post.getlist(key)
 
-    # handle multipart uploads
-    for key, file in flask.request.files.items():
-        if not media_upload:
-            continue
-
-        permalink = upload_media(file)
-        mf2["properties"].setdefault(key.replace("[]", ""), []).append(permalink)
+    # handle multipart uploads, including several files under the same key
+    if media_upload:
+        files = list(flask.request.files.items(multi=True))
+        permalinks = _upload_executor.map(upload_media, [file for _, file in files])
+        for (key, _), permalink in zip(files, permalinks):
+            mf2["properties"].setdefault(key.replace("[]", ""), []).append(permalink)
 
     return mf2
 
@@ -280,15 +325,44 @@ def update_post(payload):
                 if remove in target:
                     target.remove(remove)
 
-    content = json.dumps(updated, indent=2)
-    with open(post.filename, "w") as f:
+    content = orjson.dumps(updated, option=orjson.OPT_INDENT_2)
+    with open(post.filename, "wb") as f:
         f.write(content)
 
-    model.database.reinitialize()
+    # replace just this post's rows, and if that fails, re-ingest the
+    # partition for the post
+    try:
+        model.database.upsert(post.filename)
+    except Exception:
+        print("Failed to update content. Reinitializing partition.")
+        refresh_partition(post.filename)
+
+    site.clear_response_cache()
 
     return True
 
 
+def refresh_partition(content_path):
+    """
+    Re-ingest the Hive partition containing the specified content file, and
+    fall back to reinitializing the entire database if that fails.
+    """
+
+    partition = dict(
+        part.split("=", 1)
+        for part in pathlib.Path(content_path).parent.parts
+        if "=" in part
+    )
+
+    try:
+        model.database.reinitialize_partition(
+            int(partition["year"]), int(partition["month"]), int(partition["day"])
+        )
+    except Exception:
+        print("Failed to reinitialize partition. Reinitializing database.")
+        model.database.reinitialize()
+
+
 def delete_post(payload):
     """
     Soft delete a post by attaching a 'deleted' property into its
@@ -308,6 +382,22 @@ def undelete_post(payload):
     return update_post(payload)
 
 
+def make_slug(text, max_length=40):
+    """
+    Turn the provided text into a URL slug. Plain ASCII text is handled with
+    a couple of precompiled regular expressions, producing the same result as
+    python-slugify for a fraction of the cost. Text that needs transliteration
+    or HTML entity decoding is passed along to python-slugify.
+    """
+
+    if not text.isascii() or "&" in text:
+        return slugify.slugify(text, max_length=max_length)
+
+    text = SLUG_NUMBER_SEPARATORS.sub("", text.lower())
+    text = SLUG_DISALLOWED_CHARS.sub("-", text).strip("-")
+    return text[:max_length].strip("-")
+
+
 def generate_slug_and_uuid(mf2):
     """
     Given the provided MF2 JSON data, create a new slug and post identifier,
@@ -340,18 +430,30 @@ def generate_slug_and_uuid(mf2):
         else:
             seed = str(uuid.uuid4())
 
-    slug = slugify.slugify(seed, max_length=40)
+    slug = make_slug(seed)
+
+    year = datetime.datetime.now(datetime.timezone.utc).year
+
+    # fetch every url this year that the slug, or a numbered variant of it,
+    # would collide with in a single query, then find the first free suffix
+    url = f"/{year}/{slug}"
+    taken = {
+        existing
+        for [existing] in model.database.execute(
+            " ".join(
+                [
+                    "select url from content where (url = ? or url like ?)",
+                    "and datepart('year', published) = ?",
+                ]
+            ),
+            [url, f"{url}-%", year],
+        )
+    }
 
-    unique = False
     count = 0
-    while unique is False:
-        post = model.Post.get(year=arrow.get().year, slug=slug)
-        if post is None:
-            unique = True
-        else:
-            count += 1
-            slug = f"{slug}-{count}"
+    while url in taken:
+        count += 1
+        url = f"/{year}/{slug}-{count}"
 
-    url = f"/{arrow.get().year}/{slug}"
     props["url"] = [url]
     props["post-id"] = [uuid.uuid4().hex]
@@ -5,12 +5,20 @@ my own website, https://cleverdevil.io, though I may generalize it for others
 to use if there is sufficient demand from willing collaborators.
 """
 
-import json
+import collections
+import concurrent.futures
+import datetime
+import functools
+import os
 import pathlib
+import threading
+import time
 import urllib
 
 import arrow
 import flask
+import flask_login
+import orjson
 
 from .. import model
 
@@ -18,6 +26,89 @@ blueprint = flask.Blueprint(
     "site", __name__, template_folder=pathlib.Path("templates").absolute()
 )
 
+# the overview page runs its independent queries side by side; each worker
+# thread gets its own DuckDB cursor via model.database.execute()
+_overview_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="dwell-overview"
+)
+
+MONTH_ABBREVIATIONS = [
+    arrow.get(2000, month, 1).format("MMM") for month in range(1, 13)
+]
+
+# the decoded Overland payload behind /now, refreshed when the file changes
+_current_location = {"mtime": None, "data": None}
+
+# rendered responses for anonymous visitors, keyed by request path and query
+# string, which are dropped whenever content is published via micropub or the
+# database is reinitialized. The least recently used entries are evicted once
+# the cache is full.
+_response_cache = collections.OrderedDict()
+_response_cache_lock = threading.Lock()
+RESPONSE_CACHE_SIZE = 256
+
+
+def cache_response(ttl):
+    """
+    Decorator which caches the rendered response of a view for `ttl` seconds.
+    Logged in users always get a fresh render, as templates show them extra
+    controls.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if flask_login.current_user.is_authenticated:
+                return fn(*args, **kwargs)
+
+            key = flask.request.full_path
+            now = time.monotonic()
+            with _response_cache_lock:
+                cached = _response_cache.get(key)
+                if cached and cached[0] <= now:
+                    del _response_cache[key]
+                    cached = None
+                elif cached:
+                    _response_cache.move_to_end(key)
+
+            if cached:
+                _, status, headers, body = cached
+                return flask.Response(body, status=status, headers=headers)
+
+            response = flask.make_response(fn(*args, **kwargs))
+
+            # responses which set cookies are specific to a single visitor
+            if response.status_code == 200 and "Set-Cookie" not in response.headers:
+                entry = (
+                    now + ttl,
+                    response.status_code,
+                    list(response.headers),
+                    response.get_data(),
+                )
+                with _response_cache_lock:
+                    _response_cache[key] = entry
+                    _response_cache.move_to_end(key)
+                    while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                        _response_cache.popitem(last=False)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def clear_response_cache():
+    """
+    Drop all cached responses, so that new or updated content shows up
+    immediately.
+    """
+
+    with _response_cache_lock:
+        _response_cache.clear()
+
+
+model.database.on_migrate(clear_response_cache)
+
 
 @blueprint.route("/<int:year>/<slug>", defaults={"content_type": "html"})
 @blueprint.route("/<int:year>/<slug>.<content_type>")
@@ -46,19 +137,26 @@ def view(year, slug, content_type):
 @blueprint.route("/view/<uuid>.<content_type>")
 def view_by_id(uuid, content_type):
     """
-    HTTP GET /<year>/<slug>.<content_type>
+    HTTP GET /view/<uuid>.<content_type>
 
-    Render the post requested by the specified post uuid in the specified
-    content type, either html or json. If no content type is provided,
-    HTML is assumed. If the post cannot be found, abort with a 404.
+    Permanently redirect to the canonical URL of the post with the specified
+    post uuid, in the specified content type, either html or json. If no
+    content type is provided, HTML is assumed. If the post cannot be found,
+    abort with a 404.
     """
 
-    post = model.Post.get(uuid=uuid)
+    rows = model.database.execute(
+        "select url from content where uuid = ? limit 1", [uuid]
+    )
+
+    if not rows or not rows[0][0]:
+        flask.abort(404)
 
+    url = rows[0][0]
     if content_type == "json":
-        return post.json
+        url += ".json"
 
-    return flask.render_template("post.html", post=post, detail=True)
+    return flask.redirect(url, code=301)
 
 
 @blueprint.route("/", defaults={"content_type": "html"})
@@ -75,6 +173,7 @@ def home(content_type):
 
 
 @blueprint.route("/photos")
+@cache_response(60)
 def photos():
     """
     HTTP GET /photos
@@ -106,20 +205,27 @@ def overview():
     a sort of alternative "home" page.
     """
 
-    kwargs = dict(
-        photos=model.Photo.query(limit=40),
-        interactions=model.Bookmark.query(limit=20),
-        watches=model.Watch.query(limit=20),
-        listens=model.Listen.query(limit=20),
-        checkins=model.Checkin.query(limit=20),
-        statuses=model.Status.query(limit=75),
-        blogs=model.Post.query(limit=30, kinds=["entry", "review", "recipe"]),
+    queries = dict(
+        photos=(model.Photo, dict(limit=40)),
+        interactions=(model.Bookmark, dict(limit=20)),
+        watches=(model.Watch, dict(limit=20)),
+        listens=(model.Listen, dict(limit=20)),
+        checkins=(model.Checkin, dict(limit=20)),
+        statuses=(model.Status, dict(limit=75)),
+        blogs=(model.Post, dict(limit=30, kinds=["entry", "review", "recipe"])),
     )
 
+    futures = {
+        name: _overview_executor.submit(kind.query, **params)
+        for name, (kind, params) in queries.items()
+    }
+    kwargs = {name: future.result() for name, future in futures.items()}
+
     return flask.render_template("overview.html", **kwargs)
 
 
 @blueprint.route("/archive")
+@cache_response(300)
 def archive():
     """
     HTTP GET /archive
@@ -129,35 +235,31 @@ def archive():
     site.
     """
 
-    result = model.database.connection.sql(
+    result = model.database.execute(
         " ".join(
             [
-                "select distinct date_trunc('day', published) d",
-                "from content order by d desc",
+                "select year(published) as y, month(published) as m,",
+                "list(distinct day(published) order by day(published))",
+                "from content where year(published) <> 1900",
+                "group by y, m order by y desc",
             ]
         )
-    ).fetchall()
+    )
 
     years = []
-    current_year = 0
-    for [date] in result:
-        if date.year == 1900:
-            continue
-
-        if date.year != current_year:
-            current_year = date.year
-            year = {"year": date.year, "months": []}
-            for month in range(1, 13):
-                year["months"].append(
-                    {
-                        "month": month,
-                        "name": arrow.get(2000, month, 1).format("MMM"),
-                        "days": [],
-                    }
-                )
-            years.append(year)
-
-        years[-1]["months"][date.month - 1]["days"].insert(0, date.day)
+    for y, m, days in result:
+        if not years or years[-1]["year"] != y:
+            years.append(
+                {
+                    "year": y,
+                    "months": [
+                        {"month": month, "name": name, "days": []}
+                        for month, name in enumerate(MONTH_ABBREVIATIONS, 1)
+                    ],
+                }
+            )
+
+        years[-1]["months"][m - 1]["days"] = days
 
     return flask.render_template("archive/index.html", years=years)
 
@@ -227,13 +329,18 @@ def now():
     containing location metadata from Overland.
     """
 
-    with open("current.json") as f:
-        current = json.loads(f.read())
-        return flask.render_template("now.html", current=current)
+    mtime = os.stat("current.json").st_mtime_ns
+    if mtime != _current_location["mtime"]:
+        with open("current.json", "rb") as f:
+            data = orjson.loads(f.read())
+        _current_location.update(data=data, mtime=mtime)
+
+    return flask.render_template("now.html", current=_current_location["data"])
 
 
 @blueprint.route("/content/<kind>", defaults={"content_type": "html"})
 @blueprint.route("/content/<kind>.<content_type>")
+@cache_response(60)
 def content(kind, content_type):
     """
     HTTP GET /content/<kind>.<content_type>
@@ -252,12 +359,10 @@ def content(kind, content_type):
 
     kinds = model.get_kinds_for_alias(kind)
 
-    count = model.Post.query(
-        count=True, kinds=[kind.__kind__.capitalize() for kind in kinds]
-    )
+    count = model.Post.query(count=True, kinds=[kind.__kind__ for kind in kinds])
 
     posts = model.Post.query(
-        kinds=[kind.__kind__.capitalize() for kind in kinds], limit=limit, offset=offset
+        kinds=[kind.__kind__ for kind in kinds], limit=limit, offset=offset
     )
 
     if content_type == "json":
@@ -295,5 +400,5 @@ def on_this_day_today():
     month and day across all years of content on the site.
     """
 
-    today = arrow.get()
+    today = datetime.datetime.now(datetime.timezone.utc)
     return on_this_day(today.month, today.day)
@@ -10,36 +10,49 @@ from read_json_auto(
     hive_partitioning='true',
     filename='true'
 );
-create view content as select
-    properties->'post-id'->>0 "uuid",
-    properties->'post-kind'->>0 "kind",
-    properties->'url'->>0 "url",
-    coalesce(
-        (properties->'deleted'->>0), false
-    )::JSON::BOOL "deleted",
-    json_extract("properties",
-        '$."published"[0]')::JSON::TIMESTAMP "published",
-    json_extract("properties",
-        '$."location-metadata"')::JSON::STRUCT(
-            "timestamp" timestamp,
-            x float,
-            y float,
-            altitude int,
-            motion varchar[],
-            wifi varchar,
-            battery_level float,
-            battery_state varchar,
-            speed int,
-            year int,
-            month int,
-            day int,
-            hour int,
-            minute int
-        ) "location",
+create table content as select
+    parts[1]->>'$' "uuid",
+    lower(parts[2]->>'$') "kind",
+    parts[3]->>'$' "url",
+    coalesce(parts[4]->>'$', 'false')::BOOL "deleted",
+    (parts[5]->>'$')::TIMESTAMP "published",
+    parts[6]::STRUCT(
+        "timestamp" timestamp,
+        x float,
+        y float,
+        altitude int,
+        motion varchar[],
+        wifi varchar,
+        battery_level float,
+        battery_state varchar,
+        speed int,
+        year int,
+        month int,
+        day int,
+        hour int,
+        minute int
+    ) "location",
     properties,
     children,
     filename,
     year,
     month,
     day
-from raw_content;
+from (
+    select
+        json_extract(properties, [
+            '$."post-id"[0]',
+            '$."post-kind"[0]',
+            '$."url"[0]',
+            '$."deleted"[0]',
+            '$."published"[0]',
+            '$."location-metadata"'
+        ]) parts,
+        *
+    from raw_content
+)
+where "kind" is distinct from 'unfurledurl'
+order by year, month, day, published;
+create index content_uuid_idx on content(uuid);
+create index content_url_idx on content(url);
+create index content_published_idx on content(published);